@@ -9,17 +9,54 @@
 # Users can enter their lifts, along with some personal information, to see
 # their percentile rank among lifters from the meet who match their
 # demographic.
-
-import urllib2
-from bs4 import BeautifulSoup
+#
+# Setting the PROFILE environment variable records the scrape and the
+# percentile query with cProfile in scrape.prof, which can be explored with
+#     snakeviz scrape.prof
+
+import os
+import io
+import time
+import json
+import tempfile
+import hashlib
+import cProfile
+import requests
+from requests.adapters import HTTPAdapter
+from lxml import etree
 import sqlite3 as sq
-import pandas as pd
+import numpy as np
 import numbers
+import operator
+import itertools
+import re
+import math
+try:
+    from numba import njit, prange
+except ImportError: # Numba is optional, the NumPy equivalents are used instead
+    njit = None
 
 # The page from which the program collects powerlifting meet results
 QUOTE_PAGE = 'http://meets.revolutionpowerlifting.com/results/2016-meet-results/ny-states/'
 DATABASE = 'meet_results.db'
 MEET_RESULTS_TABLE = 'meet_results'
+PROFILE_OUTPUT = 'scrape.prof' # written by main() when PROFILE is set
+
+# Scraped pages are cached on disk so repeated runs skip the network
+HTTP_CACHE_DIRECTORY = '.http_cache'
+HTTP_CACHE_TTL = 24 * 60 * 60 # seconds a cached page is used without
+                              # asking the server whether it has changed
+HTTP_TIMEOUT = 10 # seconds to wait on the server before giving up
+
+# One session is shared by every fetch so connections to the same host are
+# kept alive and reused instead of paying a new handshake per page
+_SESSION = requests.Session()
+_SESSION.mount('http://', HTTPAdapter(pool_connections=4, pool_maxsize=8))
+_SESSION.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=8))
+
+# Populations sorted by get_sorted_population, keyed by database, table and
+# categories.  Emptied whenever populate_database loads new results.
+_sorted_populations = {}
 
 # Lifter categories
 GENDER = 'gender'
@@ -39,6 +76,7 @@ SQUAT = 'squat'
 BENCH = 'bench'
 DEADLIFT = 'deadlift'
 TOTAL = 'total'
+LIFTS = (SQUAT, BENCH, DEADLIFT, TOTAL)
 
 # Possible values for each category
 CATEGORY_VALUES = {GENDER: (FEMALE, MALE),
@@ -47,92 +85,216 @@ CATEGORY_VALUES = {GENDER: (FEMALE, MALE),
 
 # Each row of the MEET_RESULTS_TABLE contains information corresponding to
 # one lifter in the competition.  Desired information is accessed
-# through the appropriate column of the table.  Column numbers start at 0.
-# Every other column contains a whitespace string.
-GENDER_COLUMN = 1 # Column containing gender information (male or female) for
+# through the appropriate cell (<td>) of the row.  Cell numbers start at 0.
+GENDER_COLUMN = 0 # Cell containing gender information (male or female) for
                   # all lifters
-PROFESSIONAL_STATUS_COLUMN = 3 # ...
-EQUIPMENT_COLUMN = 5 # ...
-SQUAT_COLUMN = 15 # ...
-BENCH_COLUMN = 17 # ...
-DEADLIFT_COLUMN = 19 # ...
-
-FORMAT_DICTIONARY = {GENDER: GENDER_COLUMN,
-                    PROFESSIONAL_STATUS: PROFESSIONAL_STATUS_COLUMN,
-                    EQUIPMENT: EQUIPMENT_COLUMN,
-                    SQUAT: SQUAT_COLUMN,
-                    BENCH: BENCH_COLUMN,
-                    DEADLIFT: DEADLIFT_COLUMN}
+PROFESSIONAL_STATUS_COLUMN = 1 # ...
+EQUIPMENT_COLUMN = 2 # ...
+SQUAT_COLUMN = 7 # ...
+BENCH_COLUMN = 8 # ...
+DEADLIFT_COLUMN = 9 # ...
+
+# A valid lift cell holds a single unsigned weight, such as 402.5.  Anything
+# else, including a weight with units, is treated as a missing result rather
+# than guessed at.
+LIFT_PATTERN = re.compile(r'\s*(\d+(?:\.\d+)?)\s*$')
+
+# Picks the six cells above out of a row's cells in a single call
+CELL_GETTER = operator.itemgetter(GENDER_COLUMN, PROFESSIONAL_STATUS_COLUMN,
+                                  EQUIPMENT_COLUMN, SQUAT_COLUMN, BENCH_COLUMN,
+                                  DEADLIFT_COLUMN)
+
+# Statements used to create and load the meet results table, formatted with
+# the name of the table
+# total is computed by SQLite, and is NULL unless all three lifts are present
+CREATE_TABLE_SQL = """CREATE TABLE if not exists {table} (
+    lifter_id INTEGER PRIMARY KEY, gender TEXT COLLATE NOCASE,
+    professional_status TEXT COLLATE NOCASE, equipment TEXT, squat REAL,
+    bench REAL, deadlift REAL,
+    total REAL GENERATED ALWAYS AS (squat + bench + deadlift) VIRTUAL)
+    """
+# Lets get_population_by_categories look lifters up by category instead of
+# scanning the whole table
+CREATE_INDEX_SQL = """CREATE INDEX if not exists {table}_categories
+    ON {table} (gender, professional_status, equipment)
+    """
+COUNT_SQL = "SELECT COUNT(*) from {table}"
+INSERT_SQL = """INSERT INTO {table} (
+    gender,
+    professional_status,
+    equipment,
+    squat,
+    bench,
+    deadlift)
+
+    Values (?, ?, ?, ?, ?, ?)
+    """
+
+# Write-ahead logging lets readers, such as the web app, keep querying while
+# the table is loaded, and with it synchronous=NORMAL only syncs at
+# checkpoints while still keeping the database consistent
+BULK_LOAD_PRAGMAS = ("PRAGMA journal_mode=WAL",
+                     "PRAGMA synchronous=NORMAL",
+                     "PRAGMA temp_store=MEMORY",
+                     "PRAGMA cache_size=-20000") # 20 MB page cache
 
 def parse_row(row):
     """
-    Parses table row of BeautifulSoup object for categories (gender,
+    Parses table row of the meet results page for categories (gender,
     professional status, equipment) and result (squat, bench, deadlift) of
     the associated lifter.
 
     Parameters:
     -----------
-    row: bs4.element.tag
-        A table row of BeautifulSoup object which contains category and result
-        information of a lifter in the expected format (see SQUAT_COLUMN,
-        BENCH_COLUMN, etc.)
+    row: lxml.etree._Element
+        A <tr> element which contains category and result information of a
+        lifter in the expected format (see SQUAT_COLUMN, BENCH_COLUMN, etc.)
 
     Returns:
     --------
-    result_and_categories: dictionary with string keys
-        A dictionary where the keys are the categories ('gender',
-        'professional_status', 'equpiment') and lifts ('squat', 'bench',
-        'deadlift', 'total').  The category keys hold string values and the
-        lift keys have float values, if data was available for the corresponding
-        lift, and None otherwise.
-
-    """
-    row = row.contents # list of HTML objects in row
-    if row[1].get('colspan'): # row contains column headers and no data, ignore
-        return
-    results_dictionary = {field: get_data_from_table(row, field_column) \
-        for field, field_column in FORMAT_DICTIONARY.items()}
-
-    if squat and bench and deadlift: # Valid entries for each lift in row
-        results_dictionary[TOTAL] = squat + bench + deadlift
-    else:
-        results_dictionary[TOTAL] = None
+    result_and_categories: tuple
+        A tuple (gender, professional_status, equipment, squat, bench,
+        deadlift) in the column order of MEET_RESULTS_TABLE.  The categories
+        are strings and the lifts are floats, if data was available for the
+        corresponding lift, and None otherwise.  Returns None if the row
+        contains column headers, or too few cells to hold a lifter's results.
+        The total is computed by the database.
+
+    """
+    cells = row.findall('td') # the row's cells, without whitespace between
+    if len(cells) <= DEADLIFT_COLUMN: # e.g. a <th> header row, no results
+        return None
+    if cells[0].get('colspan'): # row contains column headers and no data
+        return None
+    gender, professional_status, equipment, squat, bench, deadlift = \
+        CELL_GETTER(cells)
+    # Categories are stripped so _category_filter can compare them exactly
+    return (_cell_text(gender).strip(),
+            _cell_text(professional_status).strip(),
+            _cell_text(equipment).strip(), _to_float(_cell_text(squat)),
+            _to_float(_cell_text(bench)), _to_float(_cell_text(deadlift)))
+
+def _cell_text(cell):
+    """
+    Returns all of the text inside a <td> element, including the text of any
+    elements nested in it.
+    """
+    return "".join(cell.itertext())
+
+def iterate_rows(page):
+    """
+    Yields the <tr> elements of a webpage one at a time, as they are parsed.
+    Each row is freed once the next one is requested, so memory use stays
+    bounded no matter how many rows the page holds.
+
+    Parameters:
+    -----------
+    page: bytes
+        The raw HTML of the webpage.
 
-    return results_dictionary
+    Yields:
+    -------
+    row: lxml.etree._Element
+        A <tr> element of the page, with its cells fully parsed.
 
-def get_data_from_table(row, column):
     """
-    Retrieves data from specified location in BeautifulSoup table.
+    for _, row in etree.iterparse(io.BytesIO(page), events=('end',),
+                                  tag='tr', html=True):
+        yield row
+        row.clear()
+        # Rows already handled are still attached to the table, drop them
+        while row.getprevious() is not None:
+            del row.getparent()[0]
+
+def _to_float(data):
+    """
+    Returns the text of a lift cell as a float, or None if the cell does not
+    contain a valid numerical entry.
+    """
+    # Empty cells, DNF, meaning the lifter missed all their attempts at the
+    # lift, and any other entry that isn't a plain weight fail to match, so
+    # no exception is ever raised and caught
+    match = LIFT_PATTERN.match(data)
+    if match is None:
+        return None
+    return float(match.group(1))
+
+def fetch(url, cache_directory=HTTP_CACHE_DIRECTORY, ttl=HTTP_CACHE_TTL):
+    """
+    Returns the contents of the webpage at the specified url, using a copy
+    cached on disk when possible.  A cached copy younger than ttl is returned
+    without contacting the server.  An older copy is revalidated with the
+    server using its ETag and Last-Modified headers, and only downloaded
+    again if the page has changed.
 
     Parameters:
     -----------
-    row: list of bs4.element.Tag
-    column: int
-        column in which desired data should be located
+    url: string
+        String specifying the webpage to fetch.
+    cache_directory: string
+        String specifying the directory in which cached pages are stored.
+    ttl: number
+        Number of seconds a cached page is considered fresh.
 
     Returns:
     --------
-    data: float, string, or None
-        Returns a float if the column specified is one of SQUAT_COLUMN,
-        BENCH_COLUMN, and DEADLIFT_COLUMN, and contains a valid numerical entry,
-        returns None if the column does not contain a valid numerical entry.
-        Returns a string otherwise.
-
-    """
-    data = row[column].string
-    if column in (SQUAT_COLUMN, BENCH_COLUMN, DEADLIFT_COLUMN):
-        # If the entry at the specified row and column is empty, data will
-        # have value None and TypeError will be thrown.  If the entry is DNF,
-        # meaning the lifter missed all their attempts at the lift, data will
-        # have the value 'DNF' which can't be converted to a float, and
-        # ValueError will be thrown.
-        try:
-            data = float(data)
-        except (TypeError, ValueError):
-            return None
-        else:
-            return data
-    return data
+    page: bytes
+        The raw HTML of the webpage.
+
+    """
+    # Several web app workers may start at once, so the directory may be
+    # created by another process between a check and the makedirs call
+    os.makedirs(cache_directory, exist_ok=True)
+    cache_name = hashlib.md5(url.encode('utf-8')).hexdigest() # one cache entry per url
+    page_path = os.path.join(cache_directory, cache_name + '.html')
+    headers_path = os.path.join(cache_directory, cache_name + '.json')
+
+    request_headers = {}
+    if os.path.exists(page_path):
+        if time.time() - os.path.getmtime(page_path) < ttl: # cache is fresh
+            with open(page_path, 'rb') as cached_page:
+                return cached_page.read()
+        if os.path.exists(headers_path):
+            with open(headers_path) as cached_headers:
+                validators = json.load(cached_headers)
+            if validators.get('ETag'):
+                request_headers['If-None-Match'] = validators['ETag']
+            if validators.get('Last-Modified'):
+                request_headers['If-Modified-Since'] = \
+                    validators['Last-Modified']
+
+    response = _SESSION.get(url, headers=request_headers,
+                            timeout=HTTP_TIMEOUT)
+    if response.status_code == 304: # "Not Modified", the cached page is valid
+        os.utime(page_path, None) # restart its ttl
+        with open(page_path, 'rb') as cached_page:
+            return cached_page.read()
+    response.raise_for_status()
+
+    page = response.content
+    # The page goes first, so its validators never describe an older page
+    _replace_file(page_path, page)
+    validators = {'ETag': response.headers.get('ETag'),
+                  'Last-Modified': response.headers.get('Last-Modified')}
+    _replace_file(headers_path, json.dumps(validators).encode('utf-8'))
+    return page
+
+def _replace_file(path, contents):
+    """
+    Writes the bytes contents to path through a temporary file in the same
+    directory, which then takes the place of path.  Another process reading
+    path sees either the old file or the new one, never a partly written
+    file.
+    """
+    descriptor, temporary_path = tempfile.mkstemp(
+        dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(descriptor, 'wb') as temporary_file:
+            temporary_file.write(contents)
+        os.replace(temporary_path, path)
+    except BaseException: # don't leave the temporary file behind
+        os.remove(temporary_path)
+        raise
 
 def populate_database(webpage, database, table):
     """
@@ -153,71 +315,121 @@ def populate_database(webpage, database, table):
         to store meet results.
 
     """
-    table_empty_string = "SELECT COUNT(*) from %s" % table
-
-    create_table_string = """CREATE TABLE if not exists %s (
-    lifter_id INTEGER PRIMARY KEY, gender TEXT,
-    professional_status TEXT, equipment TEXT, squat REAL,
-    bench REAL, deadlift REAL, total REAL)
-    """ % table
+    # Transactions are managed explicitly so the whole load is one commit
+    connection = sq.connect(database, isolation_level=None)
+    try:
+        for pragma in BULK_LOAD_PRAGMAS:
+            connection.execute(pragma)
+        cursor = connection.cursor() # reused for every statement of the load
+        cursor.execute(CREATE_TABLE_SQL.format(table=table))
+        cursor.execute(CREATE_INDEX_SQL.format(table=table))
+
+        # Here cursor returns a list containing the number of rows in the
+        # table, I access that number with [0]
+        meet_results_table_populated = \
+            cursor.execute(COUNT_SQL.format(table=table)).fetchone()[0] > 0
+
+        # Don't attempt to add data to table unless empty.  This check only
+        # spares a fetch, the table is counted again before inserting.
+        if meet_results_table_populated:
+            return
+
+        page = fetch(webpage)
+        # All rows of meet results table, each corresponds to an individual's
+        # performance at the meet
+        meet_results_table = iterate_rows(page)
+        # parse_row returns None for rows that don't contain results of the
+        # meet.  executemany consumes the rows as they are parsed, so neither
+        # the page's tree nor the parsed rows are ever held in memory all at
+        # once.
+        rows = (result_and_categories for result_and_categories in
+                map(parse_row, meet_results_table) if result_and_categories)
+
+        # Commits the load, or rolls it back if an insert fails
+        with connection:
+            # Takes the write lock before counting again, so of several
+            # loaders started together only the first one inserts the rows
+            cursor.execute("BEGIN IMMEDIATE")
+            if cursor.execute(COUNT_SQL.format(table=table)).fetchone()[0]:
+                return
+            cursor.executemany(INSERT_SQL.format(table=table), rows)
+    finally: # also when the fetch or an insert fails
+        connection.close()
+    _sorted_populations.clear() # cached populations predate these results
+
+####### Numeric kernels
+def _searchsorted_smaller_lifts(sorted_lifts, entered_lifts):
+    """
+    Returns the number of lifts in the ascending float64 array sorted_lifts
+    that are smaller than each of entered_lifts, a float or an array.  The
+    NumPy equivalent of the Numba kernels below, used without Numba.
+    """
+    return np.searchsorted(sorted_lifts, entered_lifts, side='left')
+
+if njit is not None:
+    # Compiled to machine code, the search avoids NumPy's per-call dispatch.
+    # Only numeric arrays are passed in, category filtering stays in SQL.
+    @njit(cache=True)
+    def _count_smaller_lifts(sorted_lifts, entered_lift):
+        """
+        Returns the number of lifts in the ascending float64 array
+        sorted_lifts that are smaller than entered_lift, found by binary
+        search.
+        """
+        low = 0
+        high = sorted_lifts.size
+        while low < high:
+            middle = (low + high) >> 1
+            if sorted_lifts[middle] < entered_lift:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    @njit(cache=True, parallel=True)
+    def _count_smaller_lifts_batch(sorted_lifts, entered_lifts):
+        """
+        Returns _count_smaller_lifts for each of the float64 entered_lifts,
+        searching for them in parallel across all cores.
+        """
+        counts = np.empty(entered_lifts.size, dtype=np.int64)
+        for i in prange(entered_lifts.size):
+            counts[i] = _count_smaller_lifts(sorted_lifts, entered_lifts[i])
+        return counts
+else:
+    _count_smaller_lifts = _searchsorted_smaller_lifts
+    _count_smaller_lifts_batch = _searchsorted_smaller_lifts
+
+def warm_up_kernels():
+    """
+    Compiles the kernel behind find_percentile ahead of time when Numba is
+    available, so that the first percentile query, such as a web app's
+    first request, doesn't wait on compilation.  Does nothing of note
+    without Numba.  The batch kernel is left to compile on first use by
+    find_percentiles, which a web app serving single queries never calls.
+    """
+    _count_smaller_lifts(np.zeros(1), 0.0)
 
-    result_storage_string = """INSERT INTO meet_results (
-    gender,
-    professional_status,
-    equipment,
-    squat,
-    bench,
-    deadlift,
-    total)
-
-    Values (
-    :gender,
-    :professional_status,
-    :equipment,
-    :squat,
-    :bench,
-    :deadlift,
-    :total
-    )
-    """
-    connection = sq.connect(database)
-    cursor = connection.cursor()
-    cursor.execute(create_table_string)
-    cursor.execute(table_empty_string)
-
-    # Here cursor returns a list containing the number of rows in the table
-    # I access that number with [0]
-    meet_results_table_populated = cursor.fetchone()[0]
-
-    # Don't attempt to add data to table unless empty
-    if meet_results_table_populated:
-        return
-
-    page = urllib2.urlopen(webpage)
-    soup = BeautifulSoup(page, 'html.parser')
-    meet_results_table = soup.find_all('tr') # all rows of meet results table,
-                                             # each corresponds to an
-                                             # individual's performance at the
-                                             # meet
-    for row in meet_results_table: # information for one lifter
-        result_and_categories = parse_row(row)
-        if result_and_categories: # row contains results of meet
-            cursor.execute(result_storage_string, result_and_categories)
-
-    connection.commit()
-    connection.close()
+####### NumPy functions
+def _is_valid_lift(lift):
+    """
+    Returns True if lift is a finite number, so it can be ranked.  NaN and
+    infinity are treated as a missing lift, since the kernels would rank
+    them differently with and without Numba.
+    """
+    return isinstance(lift, numbers.Real) and math.isfinite(lift)
 
-####### Pandas functions
-def find_percentile(lifts_df, user_lifts):
+def find_percentile(sorted_lifts, user_lifts):
     """
     Finds the percentile of the input squat, bench, deadlift and total numbers
     among the sample of results in the database.
 
     Parameters:
     -----------
-    lifts_df: pandas dataframe
-        Dataframe containing squat, bench, deadlift, and/or total numbers
-        against which to compare the input numbers.
+    sorted_lifts: dictionary with string keys and numpy array values
+        Dictionary, as returned by sort_population, where each of the keys
+        'squat', 'bench', 'deadlift', and 'total' holds the population's
+        results for that lift in ascending order.
     user_lifts: dictionary with string keys and float (or None) values
         A dictionary that contains keys ('squat', 'bench', 'deadlift', 'total').
         The values are floats representing someone's performance in the lift.
@@ -228,26 +440,271 @@ def find_percentile(lifts_df, user_lifts):
         Dictionary where key is one of "squat", "bench", and "deadlift" and
         the value is either a string relaying the input lifts percentile
         among the lifts in the database, or "N/A" if a valid number was not
-        input for the lift.
+        input for the lift or nobody in the population has a result for it.
 
     """
     percentiles = {SQUAT: None, BENCH: None, DEADLIFT: None}
     for lift in (SQUAT, BENCH, DEADLIFT, TOTAL):
-        if isinstance(user_lifts[lift], numbers.Real): # valid numeric entry for lift
-            entered_lift = user_lifts[lift]
-            all_competitor_lifts = lifts_df[lift]
-            number_of_lifts = all_competitor_lifts.count()
-            number_of_smaller_lifts = all_competitor_lifts[all_competitor_lifts < entered_lift].count()
-            percentile = (float(number_of_smaller_lifts)/number_of_lifts) * 100
-            percentiles[lift] = percentile
+        all_competitor_lifts = sorted_lifts[lift]
+        # valid numeric entry for lift, and results to compare it against
+        if _is_valid_lift(user_lifts[lift]) and all_competitor_lifts.size:
+            # The results are sorted, so the number of smaller lifts is the
+            # position the entered lift would be inserted at
+            number_of_smaller_lifts = _count_smaller_lifts(
+                all_competitor_lifts, float(user_lifts[lift]))
+            percentiles[lift] = \
+                float(number_of_smaller_lifts) / all_competitor_lifts.size * 100
         else: # no lift was entered
             percentiles[lift] = "N/A"
     return percentiles
 
+def find_percentiles(sorted_lifts, lift, entered_lifts):
+    """
+    Finds the percentile of many entered numbers for one lift among the
+    same population, such as every user of a web service compared against
+    one category.  The numbers are ranked in a single call rather than one
+    find_percentile call each.
+
+    Parameters:
+    -----------
+    sorted_lifts: dictionary with string keys and numpy array values
+        Dictionary, as returned by sort_population, where each of the keys
+        'squat', 'bench', 'deadlift', and 'total' holds the population's
+        results for that lift in ascending order.
+    lift: string
+        One of 'squat', 'bench', 'deadlift', and 'total'.
+    entered_lifts: array_like of floats
+        The numbers to rank against the population's results for the lift,
+        in an array of any shape.
+
+    Returns:
+    --------
+    percentiles: numpy array
+        float64 array holding the percentile of each entered number, in the
+        shape given.  The percentile of a NaN or infinite number is NaN, and
+        every percentile is NaN if nobody in the population has a result for
+        the lift.
+
+    """
+    all_competitor_lifts = sorted_lifts[lift]
+    entered_lifts = np.asarray(entered_lifts, dtype=np.float64)
+    if not all_competitor_lifts.size:
+        return np.full(entered_lifts.shape, np.nan)
+    # The Numba kernel only accepts one dimensional arrays, so the numbers
+    # are ranked in a flat copy and put back in their shape afterwards
+    flat_entered_lifts = np.ascontiguousarray(entered_lifts.ravel())
+    numbers_of_smaller_lifts = _count_smaller_lifts_batch(
+        all_competitor_lifts, flat_entered_lifts).reshape(entered_lifts.shape)
+    percentiles = \
+        numbers_of_smaller_lifts / float(all_competitor_lifts.size) * 100
+    percentiles[~np.isfinite(entered_lifts)] = np.nan # like a missing lift
+    return percentiles
+
+def sort_population(population):
+    """
+    Sorts each lift of a population once so that find_percentile can rank
+    lifts against it with a binary search.
+
+    Parameters:
+    -----------
+    population: dictionary with string keys and numpy array values
+        Dictionary, as returned by get_population_by_categories, containing
+        squat, bench, deadlift, and total numbers.
+
+    Returns:
+    --------
+    sorted_lifts: dictionary with string keys and numpy array values
+        Dictionary where each of the keys 'squat', 'bench', 'deadlift', and
+        'total' holds the population's results for that lift as a float64
+        array in ascending order.  Missing results are left out.
+
+    """
+    return {lift: np.sort(population[lift][~np.isnan(population[lift])])
+            for lift in LIFTS}
+
+def get_sorted_population(connection, table, categories):
+    """
+    Returns the sorted lifts of the people who fit the input categories, as
+    sort_population(get_population_by_categories(...)) would.  Sorted
+    populations are cached by database, table and categories, so repeated
+    queries for the same population skip the query and the sort.
+    Populations of in-memory and temporary databases are not cached.
+
+    Parameters:
+    -----------
+    connection: sqlite3 connection object
+        Connection to the database containing desired table
+    table: string
+        string specifying the name of the table containing desired
+        powerlifting meet results
+    categories: dictionary
+        Contains values for gender, professional_status, and equipment
+        fields to use to query the table
+
+    Returns:
+    --------
+    sorted_lifts: dictionary with string keys and numpy array values
+        See sort_population.  The arrays are shared between callers and
+        must not be modified.
+
+    """
+    # The file behind the connection's main database, so connections to
+    # different databases don't share entries
+    database = connection.execute("PRAGMA database_list").fetchone()[2]
+    if not database: # in-memory and temporary databases have no file name
+                     # to tell them apart, so they are never cached
+        return sort_population(
+            get_population_by_categories(connection, table, categories))
+    key = (database, table) + tuple(categories.get(category, "")
+                                    for category in CATEGORY_VALUES)
+    if key not in _sorted_populations:
+        _sorted_populations[key] = sort_population(
+            get_population_by_categories(connection, table, categories))
+    return _sorted_populations[key]
+
+def preload_populations(connection, table):
+    """
+    Sorts and caches the population of every combination of categories,
+    including those that leave a category empty to compare against
+    everyone, so that get_sorted_population never has to query or sort
+    while answering requests.
+
+    Parameters:
+    -----------
+    connection: sqlite3 connection object
+        Connection to the database containing desired table
+    table: string
+        string specifying the name of the table containing desired
+        powerlifting meet results
+
+    """
+    # An empty string compares the lifter against every value of a category
+    choices = [("",) + accepted_values
+               for accepted_values in CATEGORY_VALUES.values()]
+    for values in itertools.product(*choices):
+        get_sorted_population(connection, table,
+                              dict(zip(CATEGORY_VALUES, values)))
+
 def get_population_by_categories(connection, table, categories):
     """
-    Returns a dataframe containing the powerlifting results of the people who
-    fit the input categories.
+    Returns the powerlifting results of the people who fit the input
+    categories, with each lift stored as its own contiguous array.
+    Parameters:
+    -----------
+    connection: sqlite3 connection object
+        Connection to the database containing desired table
+    table: string
+        string specifying the name of the table containing desired
+        powerlifting meet results
+    categories: dictionary
+        Contains values for gender, professional_status, and equipment
+        fields to use to query the table
+    Returns:
+    --------
+    population: dictionary with string keys and numpy array values
+        Dictionary where each of the keys 'squat', 'bench', 'deadlift', and
+        'total' holds the results of all lifters who fit the input criteria
+        as a float64 array.  Missing results are NaN.
+
+    """
+    where_string, parameters = _category_filter(categories)
+    get_population_string = "SELECT %s FROM %s WHERE %s" % (", ".join(LIFTS),
+                                                           table, where_string)
+    rows = connection.execute(get_population_string, parameters).fetchall()
+    # NumPy stores the None of a missing result as NaN
+    results = np.array(rows, dtype=np.float64).reshape(-1, len(LIFTS))
+    # Each lift becomes a row of the transposed copy, laid out contiguously
+    return dict(zip(LIFTS, np.ascontiguousarray(results.T)))
+
+def find_percentile_in_database(connection, table, categories, user_lifts):
+    """
+    Finds the percentile of the input squat, bench, deadlift and total numbers
+    among the people who fit the input categories, as find_percentile does,
+    but lets SQLite count the smaller lifts.  A single query returns two
+    counts per lift, so nothing is loaded into Python or sorted.  This suits
+    one-off queries; repeated queries are better served by
+    get_sorted_population and find_percentile.
+
+    Parameters:
+    -----------
+    connection: sqlite3 connection object
+        Connection to the database containing desired table
+    table: string
+        string specifying the name of the table containing desired
+        powerlifting meet results
+    categories: dictionary
+        Contains values for gender, professional_status, and equipment
+        fields to use to query the table
+    user_lifts: dictionary with string keys and float (or None) values
+        A dictionary that contains keys ('squat', 'bench', 'deadlift', 'total').
+        The values are floats representing someone's performance in the lift.
+
+    Returns:
+    --------
+    percentile: dictionary with string keys string values
+        See find_percentile.
+
+    """
+    percentiles = {lift: "N/A" for lift in LIFTS}
+    entered_lifts = [lift for lift in LIFTS
+                     if _is_valid_lift(user_lifts[lift])]
+    if not entered_lifts:
+        return percentiles
+    where_string, parameters = _category_filter(categories)
+    # For each lift, the number of smaller lifts and the number of results
+    counts_string = "SELECT %s FROM %s WHERE %s" % (
+        ", ".join("SUM({0} < ?), COUNT({0})".format(lift)
+                  for lift in entered_lifts), table, where_string)
+    counts = connection.execute(counts_string,
+                                [user_lifts[lift] for lift in entered_lifts] +
+                                parameters).fetchone()
+    for position, lift in enumerate(entered_lifts):
+        number_of_smaller_lifts, number_of_lifts = counts[2 * position:
+                                                          2 * position + 2]
+        if number_of_lifts: # results to compare the entered lift against
+            percentiles[lift] = \
+                float(number_of_smaller_lifts) / number_of_lifts * 100
+    return percentiles
+
+def find_average(connection, table, lift, categories):
+    """
+    Returns the average of a lift among the people who fit the input
+    categories.  The average is computed by SQLite, so the matching results
+    never have to be loaded into Python.
+
+    Parameters:
+    -----------
+    connection: sqlite3 connection object
+        Connection to the database containing desired table
+    table: string
+        string specifying the name of the table containing desired
+        powerlifting meet results
+    lift: string
+        One of 'squat', 'bench', 'deadlift', and 'total'.
+    categories: dictionary
+        Contains values for gender, professional_status, and equipment
+        fields to use to query the table
+
+    Returns:
+    --------
+    average: float or None
+        The average of the lift, or None if no lifter in the population has
+        a result for it.
+
+    """
+    _check_lift(lift)
+    where_string, parameters = _category_filter(categories)
+    average_string = "SELECT AVG({lift}) FROM {table} WHERE {where}".format(
+        lift=lift, table=table, where=where_string)
+    return connection.execute(average_string, parameters).fetchone()[0]
+
+def find_standard_deviation(connection, table, lift, categories):
+    """
+    Returns the sample standard deviation of a lift among the people who fit
+    the input categories.  Like find_average, it is computed by SQLite, in a
+    single query that first finds the mean and then sums the squared
+    deviations from it.
+
     Parameters:
     -----------
     connection: sqlite3 connection object
@@ -255,25 +712,106 @@ def get_population_by_categories(connection, table, categories):
     table: string
         string specifying the name of the table containing desired
         powerlifting meet results
+    lift: string
+        One of 'squat', 'bench', 'deadlift', and 'total'.
     categories: dictionary
         Contains values for gender, professional_status, and equipment
         fields to use to query the table
+
     Returns:
     --------
-    population_dataframe: pandas dataframe
-        dataframe containing the meet results of all lifters who fit the
-        input criteria.
+    standard_deviation: float or None
+        The sample standard deviation of the lift, or None if fewer than two
+        lifters in the population have a result for it.
 
     """
-    get_population_string = """Select * from {table}
-        WHERE gender LIKE "{gender}%" AND
-        professional_status LIKE "{professional_status}%" and
-        equipment LIKE "{equipment}%";
-        """.format(table=table,**categories)
-    cursor = connection.cursor()
-    population_database = cursor.execute(get_population_string)
-    population_dataframe = pd.read_sql(get_population_string, connection)
-    return population_dataframe
+    _check_lift(lift)
+    where_string, parameters = _category_filter(categories)
+    # Deviations are taken about the mean found by the subquery, rather than
+    # subtracting the squared mean from the mean of the squares, which loses
+    # precision to cancellation when the results are large and close together
+    deviations_string = "SELECT COUNT({lift}), " \
+        "SUM(({lift} - population.mean) * ({lift} - population.mean)) " \
+        "FROM {table}, (SELECT AVG({lift}) AS mean FROM {table} " \
+        "WHERE {where}) AS population WHERE {where}".format(
+            lift=lift, table=table, where=where_string)
+    count, sum_of_squared_deviations = connection.execute(
+        deviations_string, parameters + parameters).fetchone()
+    if count < 2:
+        return None
+    return math.sqrt(sum_of_squared_deviations / (count - 1))
+
+def find_averages(connection, table, lift, categories_list):
+    """
+    Returns the average of a lift for each of several populations, such as
+    every category shown on a dashboard.  All of the averages are computed
+    by SQLite in a single pass over the table, instead of one query per
+    population.
+
+    Parameters:
+    -----------
+    connection: sqlite3 connection object
+        Connection to the database containing desired table
+    table: string
+        string specifying the name of the table containing desired
+        powerlifting meet results
+    lift: string
+        One of 'squat', 'bench', 'deadlift', and 'total'.
+    categories_list: list of dictionaries
+        Each dictionary contains values for gender, professional_status, and
+        equipment fields describing one population.
+
+    Returns:
+    --------
+    averages: list of floats or None
+        The average of the lift for each population, in the order of
+        categories_list.  An average is None if no lifter in the population
+        has a result for the lift.
+
+    """
+    _check_lift(lift)
+    averages = []
+    parameters = []
+    for categories in categories_list:
+        condition, condition_parameters = _category_filter(categories)
+        # Lifters outside the population contribute NULL, which AVG ignores
+        averages.append("AVG(CASE WHEN %s THEN %s END)" % (condition, lift))
+        parameters.extend(condition_parameters)
+    if not averages:
+        return []
+    averages_string = "SELECT %s FROM %s" % (", ".join(averages), table)
+    return list(connection.execute(averages_string, parameters).fetchone())
+
+def _check_lift(lift):
+    """
+    Raises ValueError unless lift names one of the lift columns.  Lift names
+    become part of queries, so only known columns are accepted.
+    """
+    if lift not in LIFTS:
+        raise ValueError("Unknown lift %r" % lift)
+
+def _category_filter(categories):
+    """
+    Returns an SQL condition that is true for lifters who fit the input
+    categories, along with the parameters to bind to its placeholders.
+    Categories with an empty value are left out of the condition, so they
+    match every lifter.
+    """
+    conditions = []
+    parameters = []
+    for category in (GENDER, PROFESSIONAL_STATUS):
+        if categories.get(category):
+            conditions.append("%s = ?" % category)
+            parameters.append(categories[category])
+    if categories.get(EQUIPMENT):
+        # Equipped lifters are lumped together by the suffix their
+        # classifications share (see EQUIPPED), so the value may appear
+        # anywhere in the entry
+        conditions.append("equipment LIKE ?")
+        parameters.append('%' + categories[EQUIPMENT] + '%')
+    if not conditions:
+        return "1", parameters
+    return " AND ".join(conditions), parameters
 
 def get_categories_from_user():
     """
@@ -287,22 +825,22 @@ def get_categories_from_user():
         and 'equipment') as keys and the users responses as values.
 
     """
-    print "Please respond to the following prompts. "
+    print("Please respond to the following prompts. ")
     gender = 'gender'
     professional_status = 'professional_status'
     equipment = 'equipment'
     user_categories = {GENDER: None, PROFESSIONAL_STATUS: None, EQUIPMENT: None}
-    for category_name, accepted_values in CATEGORY_VALUES.iteritems():
+    for category_name, accepted_values in CATEGORY_VALUES.items():
         prompt_for_category = "What is your %s? Please enter one of %r, " \
             % (category_name, accepted_values) + " or press Return to be " + \
             "compared to both."
         while True:
-            response = raw_input(prompt_for_category)
+            response = input(prompt_for_category)
             # User should either enter the category they want to be compared
             # against, or an empty string to be compared to both.  If their
             # response was not one of these, prompt them to try again.
             if response not in accepted_values and response:
-                print "Your entry was not valid.  Please try again."
+                print("Your entry was not valid.  Please try again.")
                 continue
             user_categories[category_name] = response
             break
@@ -322,34 +860,34 @@ def get_lifts_from_user():
         and None is loaded for the total if there are missing values.
 
     """
-    print "Please enter your lifts below in lbs."
+    print("Please enter your lifts below in lbs.")
     lifts = {SQUAT: None, BENCH: None, DEADLIFT: None}
     for lift in lifts:
         prompt_for_lift = "What is your %s? Hit return to skip this lift." \
             % lift
         while True:
             try:
-                response = raw_input(prompt_for_lift)
+                response = input(prompt_for_lift)
                 if not response: # user entered empty string
                     response = None
                     break
                 response = float(response)
                 if response < 0: # user is a smartass
-                    print "Don't be so hard on yourself.  Please answer seriously."
+                    print("Don't be so hard on yourself.  Please answer seriously.")
                     continue
                 if response > 1500: # lift is higher than world records,
                                     # user is lying or is superman
-                    print "Okay Ronnie Coleman ... I'll ask you one more time."
+                    print("Okay Ronnie Coleman ... I'll ask you one more time.")
                     continue
             except (ValueError, TypeError): # user didn't enter a number
-                print "You did not enter a number.  Please try again."
+                print("You did not enter a number.  Please try again.")
             else:
                 lifts[lift] = response
                 break
     user_entered_lifts = (lifts[SQUAT], lifts[BENCH], lifts[DEADLIFT])
-    lifts_are_numbers = [isinstance(lift, numbers.Real) for lift in user_entered_lifts]
     # True if user entered valid numbers for all lifts, False otherwise
-    valid_entries_for_all_lifts = reduce(lambda x, y: x and y, lifts_are_numbers)
+    valid_entries_for_all_lifts = all(isinstance(lift, numbers.Real)
+                                      for lift in user_entered_lifts)
     if valid_entries_for_all_lifts:
         lifts[TOTAL] = lifts[SQUAT] + lifts[BENCH] + lifts[DEADLIFT]
     else:
@@ -383,15 +921,29 @@ def format_percentiles(percentiles_dict):
                 % (key, percentile)
     return percentile_string
 
+def _call(profiler, function, *args):
+    """
+    Calls function with args, recording it with profiler unless profiler is
+    None, and returns its result.
+    """
+    if profiler is None:
+        return function(*args)
+    return profiler.runcall(function, *args)
+
 def main():
-    populate_database(QUOTE_PAGE, DATABASE, MEET_RESULTS_TABLE)
+    # Only the database work is profiled, not the time spent at the prompts
+    profiler = cProfile.Profile() if os.environ.get('PROFILE') else None
+    _call(profiler, populate_database, QUOTE_PAGE, DATABASE,
+          MEET_RESULTS_TABLE)
     connection = sq.connect(DATABASE)
     categories = get_categories_from_user()
     lifts = get_lifts_from_user()
-    competition = get_population_by_categories(connection, MEET_RESULTS_TABLE, categories)
-    percentiles = find_percentile(competition, lifts)
-    print format_percentiles(percentiles)
+    percentiles = _call(profiler, find_percentile_in_database, connection,
+                        MEET_RESULTS_TABLE, categories, lifts)
+    print(format_percentiles(percentiles))
     connection.close()
+    if profiler is not None:
+        profiler.dump_stats(PROFILE_OUTPUT)
 
 ########################
 if __name__ == "__main__":
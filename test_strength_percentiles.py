@@ -0,0 +1,309 @@
+import os
+import shutil
+import sqlite3 as sq
+import statistics
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import numpy as np
+
+import strength_percentiles as sp
+
+def _result_row(*cells):
+    """
+    Returns the HTML of a results table row holding the input cells.
+    """
+    return "<tr>%s</tr>" % "".join("<td>%s</td>" % cell for cell in cells)
+
+# A small stand-in for the meet results page, with the header rows the real
+# page uses and two lifters
+MEET_RESULTS_PAGE = ("<html><body><table>"
+                     "<tr><th>Gender</th><th>Division</th></tr>"
+                     "<tr><td colspan='10'>Women</td></tr>" +
+                     _result_row("Female", "AM", "Raw", "", "", "", "",
+                                 "300", "200", "DNF") +
+                     _result_row("Male", "Pro", "Multi-Ply", "", "", "", "",
+                                 "600", "400", "650") +
+                     "</table></body></html>").encode('utf-8')
+
+class PopulateDatabaseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.database = os.path.join(self.directory, 'meet_results.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def count_rows(self):
+        connection = sq.connect(self.database)
+        try:
+            return connection.execute(
+                sp.COUNT_SQL.format(table=sp.MEET_RESULTS_TABLE)).fetchone()[0]
+        finally:
+            connection.close()
+
+    def test_second_load_adds_no_rows(self):
+        with mock.patch.object(sp, 'fetch',
+                               return_value=MEET_RESULTS_PAGE) as fetch:
+            sp.populate_database(sp.QUOTE_PAGE, self.database,
+                                 sp.MEET_RESULTS_TABLE)
+            self.assertEqual(self.count_rows(), 2)
+            sp.populate_database(sp.QUOTE_PAGE, self.database,
+                                 sp.MEET_RESULTS_TABLE)
+            self.assertEqual(self.count_rows(), 2)
+        fetch.assert_called_once_with(sp.QUOTE_PAGE) # populated table is kept
+
+    def test_concurrent_loads_insert_once(self):
+        def slow_fetch(url):
+            time.sleep(0.2) # both loaders find the table empty meanwhile
+            return MEET_RESULTS_PAGE
+
+        loaders = [threading.Thread(target=sp.populate_database,
+                                    args=(sp.QUOTE_PAGE, self.database,
+                                          sp.MEET_RESULTS_TABLE))
+                   for _ in range(2)]
+        with mock.patch.object(sp, 'fetch', side_effect=slow_fetch) as fetch:
+            for loader in loaders:
+                loader.start()
+            for loader in loaders:
+                loader.join()
+        self.assertEqual(fetch.call_count, 2)
+        self.assertEqual(self.count_rows(), 2)
+
+def _response(status_code, content=b"", headers=None):
+    """
+    Returns a stand-in for a requests response with the input status code,
+    body and headers.
+    """
+    return mock.Mock(status_code=status_code, content=content,
+                     headers=headers or {})
+
+class FetchTest(unittest.TestCase):
+
+    URL = 'http://example.com/results/'
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def fetch(self, session, ttl):
+        with mock.patch.object(sp, '_SESSION', session):
+            return sp.fetch(self.URL, cache_directory=self.directory, ttl=ttl)
+
+    def test_fresh_cache_skips_the_server(self):
+        session = mock.Mock()
+        session.get.return_value = _response(200, b"<html>v1</html>")
+        self.assertEqual(self.fetch(session, ttl=60), b"<html>v1</html>")
+        self.assertEqual(self.fetch(session, ttl=60), b"<html>v1</html>")
+        self.assertEqual(session.get.call_count, 1)
+
+    def test_not_modified_reuses_cached_page(self):
+        session = mock.Mock()
+        session.get.return_value = _response(
+            200, b"<html>v1</html>",
+            {'ETag': '"v1"', 'Last-Modified': 'Sat, 01 Oct 2016 00:00:00 GMT'})
+        self.fetch(session, ttl=0)
+        session.get.return_value = _response(304)
+        self.assertEqual(self.fetch(session, ttl=0), b"<html>v1</html>")
+        headers = session.get.call_args[1]['headers']
+        self.assertEqual(headers['If-None-Match'], '"v1"')
+        self.assertEqual(headers['If-Modified-Since'],
+                         'Sat, 01 Oct 2016 00:00:00 GMT')
+
+    def test_changed_page_replaces_cached_page(self):
+        session = mock.Mock()
+        session.get.return_value = _response(200, b"<html>v1</html>",
+                                             {'ETag': '"v1"'})
+        self.fetch(session, ttl=0)
+        session.get.return_value = _response(200, b"<html>v2</html>",
+                                             {'ETag': '"v2"'})
+        self.assertEqual(self.fetch(session, ttl=0), b"<html>v2</html>")
+        session.get.return_value = _response(304)
+        self.assertEqual(self.fetch(session, ttl=0), b"<html>v2</html>")
+        self.assertEqual(session.get.call_args[1]['headers']['If-None-Match'],
+                         '"v2"')
+        # Only the page and its validators are left, no temporary files
+        self.assertEqual(len(os.listdir(self.directory)), 2)
+
+# The ranking kernels, scalar and batch, with and without Numba
+KERNELS = [('NumPy', sp._searchsorted_smaller_lifts,
+            sp._searchsorted_smaller_lifts)]
+if sp.njit is not None:
+    KERNELS.append(('Numba', sp._count_smaller_lifts,
+                    sp._count_smaller_lifts_batch))
+
+class PercentileTest(unittest.TestCase):
+
+    SORTED_LIFTS = {lift: np.array([100.0, 200.0, 200.0, 300.0])
+                    for lift in sp.LIFTS}
+
+    def each_kernel(self):
+        """
+        Yields once with each of KERNELS patched in, as a subtest.
+        """
+        for name, kernel, batch_kernel in KERNELS:
+            with self.subTest(kernel=name), \
+                    mock.patch.object(sp, '_count_smaller_lifts', kernel), \
+                    mock.patch.object(sp, '_count_smaller_lifts_batch',
+                                      batch_kernel):
+                yield
+
+    def test_ties_rank_below_the_tied_lifts(self):
+        for _ in self.each_kernel():
+            percentiles = sp.find_percentile(
+                self.SORTED_LIFTS, {sp.SQUAT: 200.0, sp.BENCH: 100.0,
+                                    sp.DEADLIFT: 300.0, sp.TOTAL: 301.0})
+            self.assertEqual(percentiles, {sp.SQUAT: 25.0, sp.BENCH: 0.0,
+                                           sp.DEADLIFT: 75.0,
+                                           sp.TOTAL: 100.0})
+
+    def test_non_finite_lifts_are_missing(self):
+        for _ in self.each_kernel():
+            percentiles = sp.find_percentile(
+                self.SORTED_LIFTS, {sp.SQUAT: float('nan'),
+                                    sp.BENCH: float('inf'),
+                                    sp.DEADLIFT: float('-inf'),
+                                    sp.TOTAL: None})
+            self.assertEqual(set(percentiles.values()), {"N/A"})
+
+    def test_empty_population(self):
+        empty = {lift: np.array([]) for lift in sp.LIFTS}
+        for _ in self.each_kernel():
+            percentiles = sp.find_percentile(
+                empty, {lift: 200.0 for lift in sp.LIFTS})
+            self.assertEqual(set(percentiles.values()), {"N/A"})
+
+    def test_batch_matches_single_queries(self):
+        entered_lifts = [0.0, 100.0, 150.0, 200.0, 250.0, 300.0, 301.0,
+                         float('nan'), float('inf')]
+        for _ in self.each_kernel():
+            percentiles = sp.find_percentiles(self.SORTED_LIFTS, sp.SQUAT,
+                                              entered_lifts)
+            for entered_lift, percentile in zip(entered_lifts, percentiles):
+                expected = sp.find_percentile(
+                    self.SORTED_LIFTS, {lift: entered_lift
+                                        for lift in sp.LIFTS})[sp.SQUAT]
+                if expected == "N/A":
+                    self.assertTrue(np.isnan(percentile))
+                else:
+                    self.assertEqual(percentile, expected)
+
+    def test_batch_keeps_the_shape_of_its_input(self):
+        entered_lifts = np.array([[100.0, 200.0, 300.0],
+                                  [150.0, 250.0, float('nan')]])
+        for _ in self.each_kernel():
+            percentiles = sp.find_percentiles(self.SORTED_LIFTS, sp.BENCH,
+                                              entered_lifts)
+            np.testing.assert_array_equal(
+                percentiles, [[0.0, 25.0, 75.0], [25.0, 75.0, np.nan]])
+
+    def test_batch_on_empty_population(self):
+        empty = {lift: np.array([]) for lift in sp.LIFTS}
+        for _ in self.each_kernel():
+            percentiles = sp.find_percentiles(empty, sp.TOTAL, [100.0, 200.0])
+            self.assertTrue(np.isnan(percentiles).all())
+
+class AggregateTest(unittest.TestCase):
+
+    EVERYONE = {sp.GENDER: "", sp.PROFESSIONAL_STATUS: "", sp.EQUIPMENT: ""}
+    WOMEN = {sp.GENDER: "Female", sp.PROFESSIONAL_STATUS: "",
+             sp.EQUIPMENT: ""}
+    # Large results close together, which lose most of their precision when
+    # the variance is taken as the mean of the squares minus the squared mean
+    SQUATS = {"Female": [1e8 + 0.25, 1e8 + 0.5, 1e8 + 1.0],
+              "Male": [1e8 + 2.0, 1e8 + 3.5]}
+
+    def setUp(self):
+        self.connection = sq.connect(':memory:')
+        self.addCleanup(self.connection.close)
+        self.connection.execute(
+            sp.CREATE_TABLE_SQL.format(table=sp.MEET_RESULTS_TABLE))
+        for gender, squats in self.SQUATS.items():
+            self.connection.executemany(
+                sp.INSERT_SQL.format(table=sp.MEET_RESULTS_TABLE),
+                [(gender, "AM", "Raw", squat, 200.0, None)
+                 for squat in squats])
+
+    def test_standard_deviation_matches_statistics(self):
+        everyone = self.SQUATS["Female"] + self.SQUATS["Male"]
+        for categories, squats in ((self.EVERYONE, everyone),
+                                   (self.WOMEN, self.SQUATS["Female"])):
+            self.assertAlmostEqual(
+                sp.find_standard_deviation(self.connection,
+                                           sp.MEET_RESULTS_TABLE, sp.SQUAT,
+                                           categories),
+                statistics.stdev(squats), places=9)
+        self.assertEqual(sp.find_standard_deviation(
+            self.connection, sp.MEET_RESULTS_TABLE, sp.BENCH, self.EVERYONE),
+            0.0)
+
+    def test_standard_deviation_needs_two_results(self):
+        one_lifter = {sp.GENDER: "Male", sp.PROFESSIONAL_STATUS: "",
+                      sp.EQUIPMENT: ""}
+        self.connection.execute(
+            "DELETE FROM %s WHERE squat > 1e8 + 3" % sp.MEET_RESULTS_TABLE)
+        self.assertIsNone(sp.find_standard_deviation(
+            self.connection, sp.MEET_RESULTS_TABLE, sp.SQUAT, one_lifter))
+        # No lifter has a deadlift result
+        self.assertIsNone(sp.find_standard_deviation(
+            self.connection, sp.MEET_RESULTS_TABLE, sp.DEADLIFT,
+            self.EVERYONE))
+
+    def test_averages(self):
+        everyone = self.SQUATS["Female"] + self.SQUATS["Male"]
+        self.assertAlmostEqual(
+            sp.find_average(self.connection, sp.MEET_RESULTS_TABLE, sp.SQUAT,
+                            self.EVERYONE), statistics.mean(everyone))
+        self.assertIsNone(sp.find_average(
+            self.connection, sp.MEET_RESULTS_TABLE, sp.DEADLIFT,
+            self.EVERYONE))
+        averages = sp.find_averages(self.connection, sp.MEET_RESULTS_TABLE,
+                                    sp.SQUAT, [self.EVERYONE, self.WOMEN])
+        self.assertEqual(averages, [
+            sp.find_average(self.connection, sp.MEET_RESULTS_TABLE, sp.SQUAT,
+                            categories)
+            for categories in (self.EVERYONE, self.WOMEN)])
+        self.assertAlmostEqual(averages[1],
+                               statistics.mean(self.SQUATS["Female"]))
+        self.assertEqual(sp.find_averages(self.connection,
+                                          sp.MEET_RESULTS_TABLE, sp.SQUAT,
+                                          []), [])
+
+class SortedPopulationTest(unittest.TestCase):
+
+    EVERYONE = {sp.GENDER: "", sp.PROFESSIONAL_STATUS: "", sp.EQUIPMENT: ""}
+
+    def setUp(self):
+        sp._sorted_populations.clear()
+
+    def tearDown(self):
+        sp._sorted_populations.clear()
+
+    def in_memory_database(self, squat):
+        """
+        Returns a connection to a new in-memory database holding one lifter
+        with the input squat.
+        """
+        connection = sq.connect(':memory:')
+        connection.execute(
+            sp.CREATE_TABLE_SQL.format(table=sp.MEET_RESULTS_TABLE))
+        connection.execute(sp.INSERT_SQL.format(table=sp.MEET_RESULTS_TABLE),
+                           ("Male", "AM", "Raw", squat, None, None))
+        self.addCleanup(connection.close)
+        return connection
+
+    def test_in_memory_databases_are_not_shared(self):
+        for squat in (100.0, 900.0):
+            sorted_lifts = sp.get_sorted_population(
+                self.in_memory_database(squat), sp.MEET_RESULTS_TABLE,
+                self.EVERYONE)
+            self.assertEqual(sorted_lifts[sp.SQUAT].tolist(), [squat])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,13 +1,44 @@
-from flask import Flask, request, render_template, redirect
+from flask import Flask, request, render_template, redirect, g
 import strength_percentiles as sp
 import sqlite3 as sq
+import threading
 app = Flask(__name__)
+# The ranking kernel is compiled when the app is imported, not during the
+# first request
+sp.warm_up_kernels()
 
 percentiles_string = ""
 
+# The meet results are static, so they are scraped and their populations
+# sorted once per process instead of on every request
+meet_results_loaded = False
+meet_results_lock = threading.Lock() # keeps concurrent first requests from
+                                     # loading the table twice
+
+def get_connection():
+    # One connection per request, opened the first time a handler needs it
+    # and closed by close_connection when the request ends
+    if 'connection' not in g:
+        g.connection = sq.connect(sp.DATABASE)
+    return g.connection
+
+@app.teardown_appcontext
+def close_connection(exception):
+    connection = g.pop('connection', None)
+    if connection is not None:
+        connection.close()
+
 @app.before_request
 def before_request():
-    sp.populate_database(sp.QUOTE_PAGE, sp.DATABASE, sp.MEET_RESULTS_TABLE)
+    global meet_results_loaded
+    if meet_results_loaded:
+        return
+    with meet_results_lock:
+        if not meet_results_loaded:
+            sp.populate_database(sp.QUOTE_PAGE, sp.DATABASE,
+                                 sp.MEET_RESULTS_TABLE)
+            sp.preload_populations(get_connection(), sp.MEET_RESULTS_TABLE)
+            meet_results_loaded = True
 
 @app.route('/')
 def index():
@@ -19,11 +50,9 @@ def get_lifts():
 
 @app.route('/calculate', methods=['POST'])
 def calculate_percentiles():
-    connection = sq.connect(sp.DATABASE)
     categories = {sp.GENDER: "", sp.EQUIPMENT: "", sp.PROFESSIONAL_STATUS: ""}
-    competition = sp.get_population_by_categories(connection,
-                                                  sp.MEET_RESULTS_TABLE,
-                                                  categories)
+    competition = sp.get_sorted_population(get_connection(),
+                                           sp.MEET_RESULTS_TABLE, categories)
     lifts = {sp.SQUAT: None, sp.BENCH: None, sp.DEADLIFT: None, sp.TOTAL: None}
     for lift in (sp.SQUAT, sp.BENCH, sp.DEADLIFT):
         try:
@@ -31,13 +60,12 @@ def calculate_percentiles():
         except ValueError:
             lifts[lift] = None
     try:
-        lifts[sp.TOTAL] = sum(lifts.values())
-    except TypeError:
+        lifts[sp.TOTAL] = lifts[sp.SQUAT] + lifts[sp.BENCH] + lifts[sp.DEADLIFT]
+    except TypeError: # at least one lift was left blank
         lifts[sp.TOTAL] = None
     percentiles = sp.find_percentile(competition, lifts)
     global percentiles_string
     percentiles_string = sp.format_percentiles(percentiles)
-    connection.close()
     return redirect('/')
 
 if __name__ == "__main__":